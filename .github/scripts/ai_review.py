@@ -1,7 +1,9 @@
-import os, sys, json, math, textwrap, base64
-from typing import List, Dict
-import requests
-from unidiff import PatchSet
+import os, sys, re, math, textwrap, asyncio, hashlib, sqlite3, time, functools, zlib, fnmatch
+from typing import List, Dict, Optional, Iterable
+from urllib.parse import quote, urlparse, parse_qs
+import httpx
+import orjson
+import tiktoken
 
 REVIEW_FILE_EXTS = {
     ".cs", ".csproj", ".sln",
@@ -10,6 +12,21 @@ REVIEW_FILE_EXTS = {
     ".json", ".yml", ".yaml",
     ".md"
 }
+# str.endswith aceita tupla: uma única chamada em C em vez de um any() por extensão
+_EXTS_TUPLE = tuple(REVIEW_FILE_EXTS)
+
+# Globs separados por vírgula, testados contra o caminho e contra o nome do arquivo.
+# Um ".ext" sem curinga (ex.: ".snap") vale como "*.ext".
+EXCLUDE_GLOBS = [g.strip() for g in os.getenv("EXCLUDE_GLOBS", "").split(",") if g.strip()]
+# todos os globs compilados numa única regex (fnmatch.translate já ancora o fim)
+EXCLUDE_RE = re.compile("|".join(
+    fnmatch.translate(f"*{g}" if g.startswith(".") and not any(c in g for c in "*?[") else g)
+    for g in EXCLUDE_GLOBS
+)) if EXCLUDE_GLOBS else None
+
+# O trecho do conteúdo atual no prompt é opcional: custa um GET por arquivo e tokens de entrada
+INCLUDE_FILE_PREVIEW = os.getenv("INCLUDE_FILE_PREVIEW", "false").lower() == "true"
+PREVIEW_MAX_TOKENS = int(os.getenv("PREVIEW_MAX_TOKENS", "800"))
 
 # ---- GitHub context ----
 GITHUB_REPOSITORY = os.getenv("GITHUB_REPOSITORY")
@@ -20,8 +37,8 @@ if not (GITHUB_REPOSITORY and GITHUB_EVENT_PATH and GITHUB_TOKEN):
     print("Missing GitHub environment variables.")
     sys.exit(1)
 
-with open(GITHUB_EVENT_PATH, "r", encoding="utf-8") as f:
-    event = json.load(f)
+with open(GITHUB_EVENT_PATH, "rb") as f:
+    event = orjson.loads(f.read())
 
 if "pull_request" not in event:
     print("This workflow should be triggered by pull_request.")
@@ -42,44 +59,278 @@ if not (AOAI_ENDPOINT and AOAI_KEY and AOAI_DEPLOYMENT):
 # Chat Completions endpoint (2024-xx api version funciona bem com gpt-4o-mini)
 API_VERSION = "2024-08-01-preview"
 CHAT_URL = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_DEPLOYMENT}/chat/completions?api-version={API_VERSION}"
+AOAI_TEMPERATURE = 0.2
+
+# ---- Lotes ----
+# Vários arquivos vão em uma única chamada ao AOAI, até este limite de tokens de entrada.
+BATCH_TOKEN_BUDGET = 12000
+# Cada pedaço de diff enviado ao modelo fica abaixo deste limite
+CHUNK_TOKEN_BUDGET = 6000
+# Orçamento de saída proporcional à entrada: a latência do AOAI cresce com os tokens gerados
+# MIN_OUTPUT_TOKENS é o mínimo por arquivo: cada um precisa da sua entrada no JSON de resposta
+MIN_OUTPUT_TOKENS = 300
+MAX_OUTPUT_TOKENS_PER_FILE = 1800
+MAX_OUTPUT_TOKENS = 4096
+# limite de arquivos por lote, para que o mínimo por arquivo caiba em MAX_OUTPUT_TOKENS
+MAX_BATCH_FILES = MAX_OUTPUT_TOKENS // MIN_OUTPUT_TOKENS
+ENC = tiktoken.encoding_for_model("gpt-4o-mini")
+
+# ---- Cache de respostas do AOAI e ETags do GitHub ----
+# SQLite persistido entre execuções pelo actions/cache (ver workflow).
+CACHE_DB = os.getenv("AI_REVIEW_CACHE_DB") or os.path.join(os.getenv("RUNNER_TEMP", "."), "ai_review_cache", "aoai.sqlite")
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+# AI_REVIEW_CACHE=false desliga o cache de respostas (leitura e escrita)
+AOAI_CACHE_ENABLED = os.getenv("AI_REVIEW_CACHE", "true").lower() == "true"
+# "no_cache: true" na descrição da PR força novas respostas (o cache é apenas regravado)
+# e revisa de novo arquivos que já foram revisados em execuções anteriores
+NO_CACHE = re.search(r"no_cache:\s*true", pr.get("body") or "", re.IGNORECASE) is not None
+
+# ---- HTTP ----
+# Um único AsyncClient por processo: HTTP/2 reaproveita a conexão TLS entre chamadas.
+# Semáforos separados limitam as chamadas simultâneas ao AOAI (TPM) e ao GitHub (rate limit).
+AOAI_CONCURRENCY = int(os.getenv("AI_REVIEW_PARALLEL", "8"))
+GH_CONCURRENCY = 10
+GH_HEADERS = {"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept":"application/vnd.github+json"}
+# conteúdo bruto do arquivo, sem o envelope JSON + base64
+GH_RAW_HEADERS = {**GH_HEADERS, "Accept": "application/vnd.github.raw"}
+
+# 429 (TPM do AOAI / secondary rate limit do GitHub) e 5xx transitórios são repetidos com backoff
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# POST no GitHub não é idempotente: um 502/504 pode chegar depois do review já criado
+POST_RETRY_STATUS = {429}
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+
+client: Optional[httpx.AsyncClient] = None
+aoai_semaphore: Optional[asyncio.Semaphore] = None
+gh_semaphore: Optional[asyncio.Semaphore] = None
 
 # ---- Helpers ----
-def gh_get(url: str):
-    r = requests.get(url, headers={"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept":"application/vnd.github+json"})
+async def send(method: str, url: str, stream: bool = False, retry_status: set = RETRY_STATUS, **kwargs) -> httpx.Response:
+    # erros de conexão já são repetidos pelo transport; aqui só os status de retry_status
+    for attempt in range(MAX_RETRIES + 1):
+        r = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+        if r.status_code not in retry_status or attempt == MAX_RETRIES:
+            return r
+        await r.aclose()
+        retry_after = r.headers.get("Retry-After", "")
+        await asyncio.sleep(float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+async def gh_get_response(url: str, headers: Dict = GH_HEADERS) -> httpx.Response:
+    # GET condicional: com If-None-Match o GitHub responde 304 (sem consumir rate limit)
+    # e o corpo salvo na execução anterior é reaproveitado
+    key = f"{headers['Accept']} {url}"
+    conn = get_cache_conn()
+    row = conn.execute("SELECT etag, body, headers FROM etags WHERE key = ?", (key,)).fetchone()
+    async with gh_semaphore:
+        r = await send("GET", url, headers={**headers, "If-None-Match": row[0]} if row else headers)
+    if r.status_code == 304 and row:
+        return httpx.Response(200, content=zlib.decompress(row[1]), headers=orjson.loads(row[2]), request=r.request)
     r.raise_for_status()
-    return r.json()
+    etag = r.headers.get("ETag")
+    if etag:
+        kept = {h: r.headers[h] for h in ("Content-Type", "Link") if h in r.headers}
+        conn.execute(
+            "INSERT OR REPLACE INTO etags(key, etag, body, headers, ts) VALUES (?, ?, ?, ?, ?)",
+            (key, etag, zlib.compress(r.content, 6), orjson.dumps(kept), int(time.time()))
+        )
+        conn.commit()
+    return r
+
+async def gh_get(url: str):
+    return orjson.loads((await gh_get_response(url)).content)
 
-def gh_post(url: str, payload: dict):
-    r = requests.post(url, headers={"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept":"application/vnd.github+json"}, json=payload)
+async def gh_get_all_pages(url: str) -> List:
+    # a primeira página informa a última (rel="last"); as demais são buscadas em paralelo
+    first = await gh_get_response(url)
+    items = orjson.loads(first.content)
+    last_url = first.links.get("last", {}).get("url")
+    if last_url:
+        last_page = int(parse_qs(urlparse(last_url).query)["page"][0])
+        pages = await asyncio.gather(*[gh_get(f"{url}&page={p}") for p in range(2, last_page + 1)])
+        for page in pages:
+            items.extend(page)
+    return items
+
+async def gh_post(url: str, payload: dict):
+    async with gh_semaphore:
+        r = await send(
+            "POST",
+            url,
+            retry_status=POST_RETRY_STATUS,
+            headers={**GH_HEADERS, "Content-Type": "application/json"},
+            content=orjson.dumps(payload)
+        )
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+_cache_conn: Optional[sqlite3.Connection] = None
+
+def get_cache_conn() -> sqlite3.Connection:
+    global _cache_conn
+    if _cache_conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(CACHE_DB)), exist_ok=True)
+        _cache_conn = sqlite3.connect(CACHE_DB)
+        _cache_conn.execute("CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, response BLOB, ts INT)")
+        _cache_conn.execute("CREATE TABLE IF NOT EXISTS etags(key TEXT PRIMARY KEY, etag TEXT, body BLOB, headers BLOB, ts INT)")
+        # descarta entradas expiradas para o arquivo não crescer indefinidamente
+        expired = int(time.time()) - CACHE_TTL_SECONDS
+        _cache_conn.execute("DELETE FROM cache WHERE ts < ?", (expired,))
+        _cache_conn.execute("DELETE FROM etags WHERE ts < ?", (expired,))
+        _cache_conn.commit()
+    return _cache_conn
+
+def _pack(text: str) -> bytes:
+    # respostas em markdown/JSON comprimem bem; banco menor => restore mais rápido do actions/cache
+    return zlib.compress(text.encode("utf-8"), 6)
+
+def _unpack(value) -> str:
+    # linhas gravadas antes da compressão continuam como TEXT
+    return value if isinstance(value, str) else zlib.decompress(value).decode("utf-8")
+
+def completion_key(*parts) -> str:
+    # Mesma entrada (system prompt + prompts do arquivo), deployment, versão da API
+    # e temperatura => mesma resposta, sem ir ao AOAI. max_tokens fica de fora: depende do lote,
+    # e só respostas completas (finish_reason "stop") são gravadas.
+    return hashlib.sha256(orjson.dumps(
+        [AOAI_DEPLOYMENT, API_VERSION, AOAI_TEMPERATURE, *parts],
+        option=orjson.OPT_SORT_KEYS
+    )).hexdigest()
+
+def file_cache_key(path: str, file_units: List[tuple]) -> str:
+    # o comentário de um arquivo depende só do system prompt e dos prompts dele, não do lote
+    return completion_key(SYSTEM_PROMPT, path, [prompt for _, prompt in file_units])
+
+def cache_get(key: str) -> Optional[str]:
+    if not AOAI_CACHE_ENABLED or NO_CACHE:
+        return None
+    row = get_cache_conn().execute("SELECT response, ts FROM cache WHERE key = ?", (key,)).fetchone()
+    if row and time.time() - row[1] < CACHE_TTL_SECONDS:
+        return _unpack(row[0])
+    return None
+
+def cache_put(key: str, value: str):
+    # chamado só depois que a resposta foi validada: falhas nunca são reaproveitadas
+    if not AOAI_CACHE_ENABLED:
+        return
+    conn = get_cache_conn()
+    conn.execute("INSERT OR REPLACE INTO cache(key, response, ts) VALUES (?, ?, ?)", (key, _pack(value), int(time.time())))
+    conn.commit()
+
+def is_excluded(filename: str) -> bool:
+    return EXCLUDE_RE is not None and (
+        EXCLUDE_RE.match(filename) is not None or EXCLUDE_RE.match(filename.rsplit("/", 1)[-1]) is not None
+    )
 
 def should_review(filename: str) -> bool:
-    fn = filename.lower()
-    return any(fn.endswith(ext) for ext in REVIEW_FILE_EXTS)
+    # a maioria dos caminhos já está em minúsculas: só aloca o .lower() quando o primeiro teste falha
+    return filename.endswith(_EXTS_TUPLE) or filename.lower().endswith(_EXTS_TUPLE)
 
-def fetch_pr_files() -> List[Dict]:
+async def fetch_pr_files() -> List[Dict]:
     url = f"https://api.github.com/repos/{GITHUB_REPOSITORY}/pulls/{pr_number}/files?per_page=100"
-    files = gh_get(url)
-    # você pode paginar se necessário (para PRs gigantes)
-    return [f for f in files if should_review(f.get("filename","")) and f.get("status") != "removed"]
-
-def fetch_file_content(sha: str) -> str:
-    # baixa conteúdo bruto pelo blob SHA
-    url = f"https://api.github.com/repos/{GITHUB_REPOSITORY}/git/blobs/{sha}"
-    data = gh_get(url)
-    if data.get("encoding") == "base64":
-        return base64.b64decode(data["content"]).decode("utf-8", errors="replace")
-    return data.get("content","")
-
-def split_chunks(text: str, max_chars: int = 7000) -> List[str]:
-    # corte simples por tamanho para evitar janelas muito grandes
-    if len(text) <= max_chars:
-        return [text]
-    chunks, i = [], 0
-    while i < len(text):
-        chunks.append(text[i:i+max_chars])
-        i += max_chars
+    files = await gh_get_all_pages(url)
+    return [
+        f for f in files
+        if should_review(f.get("filename","")) and not is_excluded(f.get("filename","")) and f.get("status") != "removed"
+    ]
+
+# Cada review publicado registra, num comentário HTML, os blobs (caminho -> SHA) que cobriu
+REVIEWED_MARKER_RE = re.compile(r"<!-- ai-review-files: (\{.*?\}) -->")
+# só vale o marcador publicado pelo próprio workflow: qualquer autor pode escrever o mesmo comentário HTML
+REVIEW_BOT_LOGIN = os.getenv("AI_REVIEW_BOT_LOGIN", "github-actions[bot]")
+
+def build_reviewed_marker(reviewed: Dict[str, str]) -> str:
+    return f"<!-- ai-review-files: {orjson.dumps(reviewed).decode()} -->"
+
+async def fetch_reviewed_blobs() -> set:
+    # (caminho, SHA) já revisados por execuções anteriores nesta PR
+    url = f"https://api.github.com/repos/{GITHUB_REPOSITORY}/pulls/{pr_number}/reviews?per_page=100"
+    reviewed = set()
+    for review in await gh_get_all_pages(url):
+        if (review.get("user") or {}).get("login") != REVIEW_BOT_LOGIN:
+            continue
+        for m in REVIEWED_MARKER_RE.finditer(review.get("body") or ""):
+            try:
+                reviewed.update(orjson.loads(m.group(1)).items())
+            except ValueError:
+                continue
+    return reviewed
+
+async def fetch_file_content(file_json: Dict) -> str:
+    # baixa o conteúdo bruto no HEAD da PR (Accept raw: ~33% menos bytes e nenhum decode base64)
+    # o blob é endereçado pelo SHA: conteúdo imutável, ideal para o cache de ETags
+    sha = file_json.get("sha")
+    if sha:
+        try:
+            r = await gh_get_response(f"https://api.github.com/repos/{GITHUB_REPOSITORY}/git/blobs/{sha}", headers=GH_RAW_HEADERS)
+            return r.text
+        except httpx.HTTPStatusError:
+            pass
+    url = file_json.get("contents_url") or (
+        f"https://api.github.com/repos/{GITHUB_REPOSITORY}/contents/{quote(file_json['filename'])}?ref={pr['head']['sha']}"
+    )
+    r = await gh_get_response(url, headers=GH_RAW_HEADERS)
+    return r.text
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    # corta por tokens, não por caracteres: o orçamento do prompt é medido em tokens
+    # (cada token cobre ao menos um byte UTF-8; CJK/emoji passam de um token por caractere)
+    if len(text.encode("utf-8")) <= max_tokens:
+        return text
+    tokens = ENC.encode(text)
+    return text if len(tokens) <= max_tokens else ENC.decode(tokens[:max_tokens])
+
+def iter_chunks(text: str, max_tokens: int = CHUNK_TOKEN_BUDGET) -> Iterable[str]:
+    # corte por tokens, usado só quando o texto não é um diff parseável (ou um hunk é grande demais)
+    # todo token cobre ao menos um byte UTF-8 (não um caractere: CJK/emoji usam vários tokens),
+    # então texto com poucos bytes cabe sem precisar tokenizar
+    if len(text.encode("utf-8")) <= max_tokens:
+        return (text,)
+    tokens = ENC.encode(text)
+    if len(tokens) <= max_tokens:
+        return (text,)
+    return (ENC.decode(tokens[i:i+max_tokens]) for i in range(0, len(tokens), max_tokens))
+
+_HUNK_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+@functools.lru_cache(maxsize=256)
+def _parse_patch(patch: str) -> tuple:
+    # Texto de cada hunk (a partir da linha @@), numa única passada sobre o patch.
+    # Só precisamos das fronteiras dos hunks: nada de objetos por linha como no unidiff.
+    # A API de PR files devolve só os hunks, sem cabeçalhos ---/+++ de arquivo.
+    hunks, current = [], None
+    for line in patch.splitlines(keepends=True):
+        if line.startswith("@@ ") and _HUNK_RE.match(line):
+            current = [line]
+            hunks.append(current)
+        elif current is not None:
+            current.append(line)
+    return tuple("".join(h) for h in hunks)
+
+def split_patch_chunks(patch: str, max_tokens: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    # um pedaço por grupo de hunks: nunca corta no meio de um hunk (preserva o contexto do diff)
+    if len(patch.encode("utf-8")) <= max_tokens:
+        return [patch]
+    hunks = _parse_patch(patch)
+    if not hunks:
+        return list(iter_chunks(patch, max_tokens))
+
+    chunks, current, used = [], [], 0
+    for hunk in hunks:
+        tokens = len(ENC.encode(hunk))
+        if tokens > max_tokens:
+            if current:
+                chunks.append("".join(current))
+                current, used = [], 0
+            chunks.extend(iter_chunks(hunk, max_tokens))
+            continue
+        if current and used + tokens > max_tokens:
+            chunks.append("".join(current))
+            current, used = [], 0
+        current.append(hunk)
+        used += tokens
+    if current:
+        chunks.append("".join(current))
     return chunks
 
 SYSTEM_PROMPT = """Você é um revisor de código sênior. Avalie alterações em PRs com foco em:
@@ -90,109 +341,351 @@ SYSTEM_PROMPT = """Você é um revisor de código sênior. Avalie alterações e
 - Testabilidade (cobertura, casos faltantes, mocks);
 - Estilo e consistência (linters, convenções do projeto).
 
-Responda sucintamente, mas com exemplos concretos (trechos de código em blocos).
-Quando possível, sugira diffs com ```suggestion``` para facilitar o apply no GitHub.
+Você receberá um ou mais arquivos, cada um iniciado pelo marcador `=== FILE: <caminho> ===`.
+Responda APENAS com um objeto JSON no formato:
+{"files": [{"path": "<caminho>", "feedback": "<markdown>", "suggestions": [{"start_line": <int>, "end_line": <int>, "replacement": "<código corrigido>", "rationale": "<motivo>"}]}]}
+
+- Inclua uma entrada em "files" para cada arquivo recebido, usando exatamente o caminho do marcador.
+- "feedback": problemas específicos por tópicos, sucintos, com exemplos concretos; se o diff estiver ok, diga explicitamente que não encontrou nada crítico.
+- "suggestions": trechos corrigidos, com as linhas do arquivo novo (lado direito do diff) que devem ser substituídas; use [] se não houver.
 """
 
-def call_aoai(messages: List[Dict], temperature: float = 0.2) -> str:
+async def call_aoai(messages: List[Dict], temperature: float = AOAI_TEMPERATURE, max_tokens: int = 1200) -> str:
     payload = {
         "messages": messages,
         "temperature": temperature,
-        "max_tokens": 1200
+        "max_tokens": max_tokens,
+        "response_format": {"type": "json_object"},
+        # streaming (SSE): os tokens chegam enquanto o modelo gera, sem esperar o corpo inteiro
+        "stream": True
     }
-    r = requests.post(
-        CHAT_URL,
-        headers={"api-key": AOAI_KEY, "Content-Type": "application/json"},
-        json=payload,
-        timeout=90
-    )
-    r.raise_for_status()
-    data = r.json()
-    return data["choices"][0]["message"]["content"]
+    parts, finish_reason = [], None
+    async with aoai_semaphore:
+        r = await send(
+            "POST",
+            CHAT_URL,
+            stream=True,
+            headers={"api-key": AOAI_KEY, "Content-Type": "application/json"},
+            content=orjson.dumps(payload)
+        )
+        try:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                # o Azure envia eventos sem choices (ex.: resultados do filtro de conteúdo)
+                for choice in orjson.loads(data).get("choices") or []:
+                    parts.append((choice.get("delta") or {}).get("content") or "")
+                    finish_reason = choice.get("finish_reason") or finish_reason
+        finally:
+            await r.aclose()
+    # "length" (max_tokens) ou "content_filter" cortam a resposta: não é um JSON confiável
+    if finish_reason != "stop":
+        raise RuntimeError(f"resposta incompleta do modelo (finish_reason={finish_reason})")
+    ans = "".join(parts)
+    if not ans.strip():
+        raise RuntimeError("resposta vazia do modelo")
+    return ans
 
 def build_file_prompt(filename: str, patch: str, content: str) -> str:
     # Mostre diff e trechos relevantes do arquivo
     # (evita mandar arquivo inteiro para modelos pequenos)
-    preview = content[:4000]  # prevenção simples
-    return textwrap.dedent(f"""
-    Arquivo: {filename}
-
+    # o caminho vai só no marcador do lote: diffs iguais em arquivos diferentes geram o mesmo prompt
+    prompt = textwrap.dedent(f"""
     DIFF (unified):
     ```
-    {patch[:6000]}
+    {patch}
     ```
-
+    """)
+    if not content:
+        return prompt
+    preview = truncate_tokens(content, PREVIEW_MAX_TOKENS)
+    return prompt + textwrap.dedent(f"""
     Trecho do conteúdo atual (início):
     ```
     {preview}
     ```
-
-    Tarefa:
-    - Aponte problemas específicos por tópicos.
-    - Dê sugestões práticas e, quando aplicável, use blocos ```suggestion``` com o trecho corrigido.
-    - Se o diff estiver ok, diga explicitamente que não encontrou nada crítico.
     """)
 
-def post_review_comment(markdown_body: str):
+def build_batched_prompt(units: List[tuple]) -> str:
+    # units: [(caminho, prompt do arquivo)], delimitados para o modelo separar as respostas
+    return "\n\n".join(f"=== FILE: {path} ===\n{prompt}" for path, prompt in units)
+
+def build_batches(units: List[tuple], budget: int = BATCH_TOKEN_BUDGET) -> List[List[tuple]]:
+    # empacotamento guloso: acumula prompts até estourar o orçamento de tokens
+    # ou o número máximo de arquivos (pedaços do mesmo arquivo contam uma vez)
+    batches, current, used, paths = [], [], 0, set()
+    for path, prompt in units:
+        tokens = len(ENC.encode(prompt))
+        new_file = path not in paths
+        if current and (used + tokens > budget or (new_file and len(paths) >= MAX_BATCH_FILES)):
+            batches.append(current)
+            current, used, paths = [], 0, set()
+        current.append((path, prompt))
+        used += tokens
+        paths.add(path)
+    if current:
+        batches.append(current)
+    return batches
+
+_JSON_BLOCK_RE = re.compile(r"```json\s*(\{.*?\})\s*```", re.DOTALL | re.IGNORECASE)
+
+def output_token_budget(prompt: str, n_files: int) -> int:
+    input_tokens = len(ENC.encode(prompt))
+    cap = min(MAX_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS_PER_FILE * n_files)
+    # o piso cresce com o número de arquivos: lote de muitos arquivos pequenos não pode ser cortado
+    return min(cap, max(MIN_OUTPUT_TOKENS * n_files, int(input_tokens * 0.5)))
+
+def extract_review_json(text: str) -> Dict:
+    try:
+        return orjson.loads(text)
+    except ValueError:
+        # alguns modelos ainda embrulham o JSON em um bloco ```json
+        m = _JSON_BLOCK_RE.search(text)
+        if not m:
+            raise
+        return orjson.loads(m.group(1))
+
+# ``` dentro da sugestão fecharia o bloco ```suggestion; um zero-width space o neutraliza
+_BACKTICKS = "```"
+_BACKTICKS_SAFE = "``\u200b`"
+
+@functools.lru_cache(maxsize=512)
+def sanitize_replacement(repl: str) -> str:
+    return repl.replace(_BACKTICKS, _BACKTICKS_SAFE).rstrip("\n")
+
+def _coerce_suggestion(s) -> Optional[tuple]:
+    # validação explícita do que o modelo devolveu: entradas malformadas são descartadas sem exceção
+    if not isinstance(s, dict):
+        return None
+    start, end = s.get("start_line"), s.get("end_line")
+    if not (isinstance(start, (int, float)) and isinstance(end, (int, float))) or not 1 <= start <= end:
+        return None
+    repl = s.get("replacement")
+    if not isinstance(repl, str) or not repl.strip():
+        return None
+    return int(start), int(end), repl, str(s.get("rationale") or "").strip()
+
+def render_file_feedback(item: Dict) -> str:
+    feedback = item.get("feedback")
+    feedback = feedback.strip() if isinstance(feedback, str) else ""
+    suggestions = item.get("suggestions")
+    valid = [c for c in map(_coerce_suggestion, suggestions if isinstance(suggestions, list) else []) if c]
+    # lista montada numa passada e juntada uma única vez (sem gerador dentro do join)
+    parts = [feedback] if feedback else []
+    parts += [
+        f"**Linhas {start}-{end}:** {rationale}\n```suggestion\n{sanitize_replacement(repl)}\n```"
+        for start, end, repl, rationale in valid
+    ]
+    return "\n\n".join(parts)
+
+async def post_review_comment(markdown_body: str):
     # Publica um único review consolidado
     url = f"https://api.github.com/repos/{GITHUB_REPOSITORY}/pulls/{pr_number}/reviews"
     payload = {"body": markdown_body, "event": "COMMENT"}
-    gh_post(url, payload)
+    await gh_post(url, payload)
 
 def get_diff_for_file(file_json: Dict) -> str:
     # utiliza o patch fornecido pela própria API de PR files
     return file_json.get("patch", "")
 
-# ---- Execução ----
-files = fetch_pr_files()
-if not files:
-    post_review_comment("🤖 Nenhum arquivo relevante para revisão automática (extensões filtradas).")
-    sys.exit(0)
+# Arquivos que não valem uma chamada ao AOAI: lockfiles, minificados e código gerado
+_GENERATED_PATH_RE = re.compile(
+    r"(^|/)(package-lock\.json|npm-shrinkwrap\.json|packages\.lock\.json|pnpm-lock\.yaml)$"
+    r"|\.min\.(js|css)$|\.(designer|g|g\.i)\.cs$",
+    re.IGNORECASE
+)
+# só marcadores de geradores: "do not edit" em prosa comum não conta (falso positivo pula revisão real).
+# O "+" opcional cobre o cabeçalho lido do diff de um arquivo novo.
+_GENERATED_HEADER_RE = re.compile(
+    r"<auto-generated|@generated"
+    r"|^\+?[ \t]*(?://|#|/?\*|<!--)[ \t]*(?:Code generated .*)?DO NOT EDIT",
+    re.MULTILINE
+)
+# nestes formatos a indentação tem significado: mudança de espaço não é trivial
+_INDENT_SENSITIVE_EXTS = (".py", ".yml", ".yaml")
+
+def is_whitespace_only(patch: str) -> bool:
+    # em cada hunk, removidas e adicionadas têm a mesma sequência de tokens separados por espaço:
+    # compara tokens, não o texto colado ("return x" -> "returnx" não é só espaço)
+    hunks = _parse_patch(patch)
+    if not hunks:
+        return False
+    for hunk in hunks:
+        lines = hunk.splitlines()[1:]
+        removed = [t for l in lines if l.startswith("-") for t in l[1:].split()]
+        added = [t for l in lines if l.startswith("+") for t in l[1:].split()]
+        if removed != added:
+            return False
+    return True
 
-all_sections = []
-for f in files:
+def trivial_change_reason(f: Dict, patch: str, content: str) -> Optional[str]:
+    if _GENERATED_PATH_RE.search(f["filename"]):
+        return "lockfile / arquivo gerado"
+    # o cabeçalho do arquivo fica no início do conteúdo (ou do diff, quando o arquivo é novo)
+    header = content[:1000] if content else (patch[:1000] if f.get("status") == "added" else "")
+    if _GENERATED_HEADER_RE.search(header):
+        return "código gerado"
+    if not f["filename"].lower().endswith(_INDENT_SENSITIVE_EXTS) and is_whitespace_only(patch):
+        return "apenas espaços em branco"
+    return None
+
+async def prepare_file(f: Dict) -> tuple:
+    # retorna (pedaços para o AOAI, motivo de dispensa da revisão)
     filename = f["filename"]
     patch = get_diff_for_file(f) or ""
     # pular arquivos sem patch (binários ou renomeações sem alteração)
     if not patch.strip():
-        continue
+        return [], None
+    if _GENERATED_PATH_RE.search(filename):
+        return [], trivial_change_reason(f, patch, "")
 
-    # baixa conteúdo do arquivo no HEAD da PR
-    head_sha = f.get("sha")
+    # arquivo novo: o diff já traz o conteúdo inteiro, não há o que baixar
     content = ""
-    if head_sha:
+    if INCLUDE_FILE_PREVIEW and f.get("status") != "added":
         try:
-            content = fetch_file_content(head_sha)
+            content = await fetch_file_content(f)
         except Exception as e:
             content = ""
-    
-    prompt = build_file_prompt(filename, patch, content)
-    chunks = split_chunks(prompt, max_chars=7000)
-
-    file_feedback_parts = []
-    for i, chunk in enumerate(chunks, start=1):
-        messages = [
-            {"role":"system", "content": SYSTEM_PROMPT},
-            {"role":"user", "content": chunk}
-        ]
-        try:
-            ans = call_aoai(messages)
-            file_feedback_parts.append(ans.strip())
-        except Exception as e:
-            file_feedback_parts.append(f"Falha ao analisar este bloco ({i}): {e}")
-
-    section = f"### `{filename}`\n" + "\n\n".join(file_feedback_parts)
-    all_sections.append(section)
-
-if not all_sections:
-    body = "🤖 Consegui ler os arquivos, mas não havia *diff* textual analisável."
-else:
-    body = (
-        "## 🤖 Azure OpenAI Code Review\n"
-        f"- PR: #{pr_number}\n"
-        "- Escopo: arquivos filtrados por extensão e *diff* textual.\n\n"
-        + "\n\n---\n\n".join(all_sections)
-    )
 
-post_review_comment(body)
-print("AI review posted.")
+    reason = trivial_change_reason(f, patch, content)
+    if reason:
+        return [], reason
+
+    # o trecho do conteúdo vai só no primeiro pedaço para não repetir tokens
+    return [
+        (filename, build_file_prompt(filename, chunk, content if i == 0 else ""))
+        for i, chunk in enumerate(split_patch_chunks(patch))
+    ], None
+
+async def review_batch(batch: List[tuple]) -> tuple:
+    # retorna (feedback por caminho, sucesso) — lotes com falha não entram no marcador de revisados
+    paths = {path for path, _ in batch}
+    prompt = build_batched_prompt(batch)
+    messages = [
+        {"role":"system", "content": SYSTEM_PROMPT},
+        {"role":"user", "content": prompt}
+    ]
+    try:
+        ans = await call_aoai(messages, max_tokens=output_token_budget(prompt, len(paths)))
+        data = extract_review_json(ans)
+    except Exception as e:
+        return {path: [f"Falha ao analisar este lote: {e}"] for path in paths}, False
+
+    items = data.get("files") if isinstance(data, dict) else None
+    feedback: Dict[str, List[str]] = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        path = item.get("path")
+        rendered = render_file_feedback(item) if isinstance(path, str) and path in paths else ""
+        if rendered:
+            feedback.setdefault(path, []).append(rendered)
+    return feedback, True
+
+# ---- Execução ----
+async def main():
+    global client, aoai_semaphore, gh_semaphore
+    aoai_semaphore = asyncio.Semaphore(AOAI_CONCURRENCY)
+    gh_semaphore = asyncio.Semaphore(GH_CONCURRENCY)
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=MAX_RETRIES)
+    async with httpx.AsyncClient(transport=transport, timeout=90) as c:
+        client = c
+
+        files, reviewed_blobs = await asyncio.gather(fetch_pr_files(), fetch_reviewed_blobs())
+        if not files:
+            await post_review_comment("🤖 Nenhum arquivo relevante para revisão automática (extensões filtradas).")
+            return
+
+        # arquivos cujo blob já foi revisado não geram nova chamada nem novo comentário
+        pending = files if NO_CACHE else [f for f in files if (f["filename"], f.get("sha")) not in reviewed_blobs]
+        skipped = len(files) - len(pending)
+        if not pending:
+            print("All files were already reviewed in previous runs.")
+            return
+        files = pending
+
+        # conteúdo dos arquivos em paralelo; depois os prompts são agrupados em lotes
+        prepared = await asyncio.gather(*[prepare_file(f) for f in files])
+        # cache por arquivo, consultado antes do empacotamento: a composição dos lotes muda
+        # a cada execução, mas o prompt de um arquivo inalterado não
+        feedback_by_path: Dict[str, List[str]] = {}
+        cache_keys: Dict[str, str] = {}
+        # diffs idênticos (mesmo boilerplate em vários arquivos) vão uma única vez ao modelo;
+        # a resposta do primeiro arquivo é replicada para os demais
+        owners: Dict[tuple, str] = {}
+        shared: Dict[str, str] = {}
+        units = []
+        for f, (file_units, _) in zip(files, prepared):
+            if not file_units:
+                continue
+            filename = f["filename"]
+            key = file_cache_key(filename, file_units)
+            cached = cache_get(key)
+            if cached is not None:
+                feedback_by_path[filename] = orjson.loads(cached)
+                continue
+            cache_keys[filename] = key
+            # a extensão entra na chave: o mesmo texto pode ser ok em C# e não em TS
+            owner = owners.setdefault((os.path.splitext(filename)[1].lower(), *(p for _, p in file_units)), filename)
+            if owner == filename:
+                units.extend(file_units)
+            else:
+                shared[filename] = owner
+
+        batches = build_batches(units)
+        results = await asyncio.gather(*[review_batch(b) for b in batches])
+
+        failed_paths = set()
+        for result, ok in results:
+            for path, parts in result.items():
+                feedback_by_path.setdefault(path, []).extend(parts)
+                if not ok:
+                    failed_paths.add(path)
+        for path, owner in shared.items():
+            feedback_by_path[path] = list(feedback_by_path.get(owner, []))
+            if owner in failed_paths:
+                failed_paths.add(path)
+
+        # só entra no cache o arquivo cujos lotes responderam com JSON válido e algum comentário
+        for path, key in cache_keys.items():
+            if path not in failed_paths and feedback_by_path.get(path):
+                cache_put(key, orjson.dumps(feedback_by_path[path]).decode())
+
+        all_sections = []
+        reviewed: Dict[str, str] = {}
+        # ordem estável entre execuções, independente de qual lote terminou primeiro
+        for f, (file_units, trivial_reason) in sorted(zip(files, prepared), key=lambda p: p[0]["filename"]):
+            if not file_units and not trivial_reason:
+                continue
+            filename = f["filename"]
+            # só entra no marcador o que foi de fato revisado: dispensado, ou com resposta do modelo
+            # (arquivo omitido pelo modelo volta a ser enviado na próxima execução, como no cache)
+            if f.get("sha") and filename not in failed_paths and (trivial_reason or feedback_by_path.get(filename)):
+                reviewed[filename] = f["sha"]
+            if trivial_reason:
+                file_feedback_parts = [f"Sem alterações relevantes ({trivial_reason}); revisão automática dispensada."]
+            else:
+                file_feedback_parts = feedback_by_path.get(filename) or ["O modelo não retornou comentários para este arquivo."]
+            all_sections.append(f"### `{filename}`\n" + "\n\n".join(file_feedback_parts))
+
+        if not all_sections:
+            body = "🤖 Consegui ler os arquivos, mas não havia *diff* textual analisável."
+        else:
+            body = (
+                "## 🤖 Azure OpenAI Code Review\n"
+                f"- PR: #{pr_number}\n"
+                "- Escopo: arquivos filtrados por extensão e *diff* textual.\n"
+                + (f"- Arquivos sem alterações desde a última revisão: {skipped}\n" if skipped else "")
+                + "\n"
+                + "\n\n---\n\n".join(all_sections)
+                + "\n\n" + build_reviewed_marker(reviewed)
+            )
+
+        await post_review_comment(body)
+    print("AI review posted.")
+
+asyncio.run(main())